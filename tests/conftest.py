@@ -0,0 +1,30 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# 测试使用临时数据库和本地假 LLM，必须在导入 app 之前设置
+_db_dir = tempfile.mkdtemp(prefix='app-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_db_dir, 'test.db')
+os.environ['LLM_BACKEND'] = 'fake'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def m():
+    return app_module
+
+
+@pytest.fixture
+def ctx(m):
+    with m.app.app_context():
+        yield
+        m.db.session.rollback()
+
+
+@pytest.fixture
+def client(m):
+    return m.app.test_client()
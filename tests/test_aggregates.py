@@ -0,0 +1,120 @@
+import datetime
+import itertools
+
+import pytest
+
+_seq = itertools.count(1)
+
+
+def _snapshot(m, class_id):
+    """班级聚合的当前内容（用于与完全重建的结果比较）"""
+    db = m.db
+    cw_ids = [cw_id for (cw_id,) in db.session.query(m.Coursework.cw_id).filter_by(class_id=class_id)]
+    scores = sorted(
+        (r.cw_id, r.bank_id, r.student_id, r.sub_id, r.score)
+        for r in m.CourseworkScore.query.filter_by(class_id=class_id)
+    )
+    students = sorted(
+        (r.student_id, r.bank_type, round(r.score_sum, 6), r.score_count)
+        for r in m.ScoreAggregate.query.filter_by(class_id=class_id)
+    )
+    courseworks = sorted(
+        (r.cw_id, round(r.score_sum, 6), r.score_count)
+        for r in m.CourseworkAggregate.query.filter(m.CourseworkAggregate.cw_id.in_(cw_ids))
+    )
+    averages = sorted((c.cw_id, c.avg_score) for c in m.Coursework.query.filter_by(class_id=class_id).populate_existing())
+    return scores, students, courseworks, averages
+
+
+def _rebuilt(m, class_id):
+    m.rebuild_class_aggregates(class_id)
+    m.db.session.flush()
+    return _snapshot(m, class_id)
+
+
+@pytest.fixture
+def scored_class(m, ctx):
+    """一个班级：两份作业（含一个未设置类型的题库），三名学生各有提交"""
+    db = m.db
+    n = next(_seq)
+    now = datetime.datetime.utcnow()
+    cls = m.Class(classname=f'agg-{n}', creator_id=1)
+    banks = [m.Bank(bank_name=f'agg-{n}-{t}', bank_type=t) for t in ('Reading', 'writing', None)]
+    students = [m.Student(username=f'agg-{n}-{i}', email=f'agg-{n}-{i}@x', password='x') for i in range(3)]
+    db.session.add_all([cls, *banks, *students])
+    db.session.flush()
+    cws = [m.Coursework(class_id=cls.class_id, create_time=now - datetime.timedelta(days=10),
+                        deadline=now + datetime.timedelta(days=d), avg_score=0.0) for d in (1, -1)]
+    db.session.add_all(cws)
+    db.session.flush()
+    for cw in cws:
+        db.session.add_all([m.CwBank(cw_id=cw.cw_id, bank_id=b.bank_id) for b in banks])
+    for i, s in enumerate(students[:2]):
+        db.session.add(m.StudentCourses(student_id=s.student_id, class_id=cls.class_id))
+    for i, s in enumerate(students):
+        for j, b in enumerate(banks):
+            db.session.add(m.Submission(bank_id=b.bank_id, student_id=s.student_id,
+                                        sub_time=now - datetime.timedelta(days=5, hours=j),
+                                        score=None if (i, j) == (0, 1) else 10 * (i + 1) + j, type='test'))
+    db.session.flush()
+    m.rebuild_class_aggregates(cls.class_id)
+    db.session.flush()
+    return cls.class_id, [s.student_id for s in students]
+
+
+def test_add_student_matches_rebuild(m, scored_class):
+    class_id, student_ids = scored_class
+    m.db.session.add(m.StudentCourses(student_id=student_ids[2], class_id=class_id))
+    m.db.session.flush()
+    m.add_students_to_aggregates(class_id, [student_ids[2]])
+    m.db.session.flush()
+    incremental = _snapshot(m, class_id)
+    assert incremental == _rebuilt(m, class_id)
+    assert any(row[2] == student_ids[2] for row in incremental[0])
+
+
+def test_remove_student_matches_rebuild(m, scored_class):
+    class_id, student_ids = scored_class
+    m.StudentCourses.query.filter_by(student_id=student_ids[0], class_id=class_id).delete()
+    m.remove_students_from_aggregates(class_id, [student_ids[0]])
+    m.db.session.flush()
+    incremental = _snapshot(m, class_id)
+    assert incremental == _rebuilt(m, class_id)
+    assert not any(row[2] == student_ids[0] for row in incremental[0])
+
+
+def test_untyped_bank_counts_only_for_coursework(m, scored_class):
+    class_id, student_ids = scored_class
+    _, students, courseworks, _ = _snapshot(m, class_id)
+    assert {bank_type for _, bank_type, _, _ in students} == {'reading', 'writing'}
+    # 每份作业：学生 0 两个有分提交，学生 1 三个
+    assert all(count == 5 for _, _, count in courseworks)
+
+
+def test_submission_on_untyped_bank_updates_coursework(m, scored_class):
+    class_id, student_ids = scored_class
+    bank = m.Bank.query.filter(m.Bank.bank_name.like('agg-%'), m.Bank.bank_type.is_(None)).order_by(
+        m.Bank.bank_id.desc()).first()
+    sub = m.Submission(bank_id=bank.bank_id, student_id=student_ids[1],
+                       sub_time=datetime.datetime.utcnow(), score=99, type='test')
+    m.db.session.add(sub)
+    m.db.session.flush()
+    m.apply_submission_score(sub)
+    m.db.session.flush()
+    assert _snapshot(m, class_id) == _rebuilt(m, class_id)
+
+
+def test_roster_endpoints_keep_aggregates_in_sync(m, client, scored_class):
+    class_id, student_ids = scored_class
+    m.db.session.commit()
+
+    resp = client.post(f'/api/class/{class_id}/students', json={'student_ids': student_ids})
+    assert resp.get_json()['added'] == 1
+    m.db.session.expire_all()
+    assert _snapshot(m, class_id) == _rebuilt(m, class_id)
+    m.db.session.rollback()
+
+    resp = client.delete(f'/api/class/{class_id}/student/{student_ids[1]}')
+    assert resp.status_code == 200
+    m.db.session.expire_all()
+    assert _snapshot(m, class_id) == _rebuilt(m, class_id)
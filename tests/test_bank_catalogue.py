@@ -0,0 +1,41 @@
+import pytest
+
+
+@pytest.fixture
+def catalogue(m, ctx):
+    banks = [m.Bank(bank_name=name, bank_type=bank_type, location=location, display_order=i)
+             for i, (name, bank_type, location) in enumerate([
+                 ('Cat Reading', 'reading', '1:2'),
+                 ('Dog Essay', 'writing', '1:3'),
+                 ('Catalogue', 'listening', '2:1'),
+                 ('X', None, None),
+             ])]
+    m.db.session.add_all(banks)
+    m.db.session.flush()
+    catalogue = m.BankCatalogue()
+    rows, fields, _ = catalogue._build()
+    return catalogue, rows, fields
+
+
+@pytest.mark.parametrize('query', ['c', 'x', 'ca', ':2', 'cat', 'ess', 'catal', 'reading', 'zz', 'qqqq'])
+def test_search_matches_substring_scan(m, catalogue, query):
+    catalogue, rows, fields = catalogue
+    expected = [rows[p]['bank_id'] for p in range(len(rows)) if any(query in text for text in fields[p])]
+    total, page = catalogue.search(query)
+    assert total == len(expected)
+    assert [row['bank_id'] for row in page] == expected
+
+
+def test_short_queries_use_posting_lists(m, catalogue):
+    catalogue, rows, fields = catalogue
+    _, _, postings = catalogue._get()[0]
+    assert catalogue._match('ca', fields, postings, catalogue.version) is postings['ca']
+    assert catalogue._match('q', fields, postings, catalogue.version) == []
+
+
+@pytest.mark.parametrize('params', [{}, {'search': 'cat'}, {'page': 1, 'per_page': 2}])
+def test_get_banks_always_returns_envelope(m, client, params):
+    body = client.get('/api/banks', query_string=params).get_json()
+    assert set(body) == {'banks', 'total', 'page', 'per_page'}
+    assert body['page'] == params.get('page')
+    assert sum(len(banks) for banks in body['banks'].values()) <= body['total']
@@ -0,0 +1,83 @@
+import itertools
+import json
+
+_seq = itertools.count(1)
+
+
+def _document(location, name='Imported', answer='A', extra_small=False):
+    smalls = [{'question_number': 1, 'question_content': 'Q1', 'question_options': 'A|B', 'question_answer': answer}]
+    if extra_small:
+        smalls.append({'question_number': 2, 'question_content': 'Q2', 'question_options': 'A|B',
+                       'question_answer': 'B'})
+    return json.dumps({
+        'source_id': location,
+        'bank': {'bank_name': name, 'bank_type': 'reading', 'location': location, 'display_order': 1},
+        'resources': [{'resource_information': 'passage', 'resource_type': 'TEXT'}],
+        'big_questions': [{'type': 'choice', 'question_description': 'd', 'start_number': 1, 'end_number': 2,
+                           'if_nb': 0, 'small_questions': smalls}]
+    })
+
+
+def _bank_tree(m, bank_id):
+    bigs = m.BigQuestion.query.filter_by(bank_id=bank_id).all()
+    smalls = m.SmallQuestion.query.filter(m.SmallQuestion.big_id.in_([b.big_id for b in bigs])).order_by(
+        m.SmallQuestion.question_number).all()
+    return (m.db.session.get(m.Bank, bank_id, populate_existing=True), bigs,
+            [(s.question_number, s.question_answer) for s in smalls],
+            m.Resource.query.filter_by(bank_id=bank_id).count())
+
+
+def test_import_inserts_and_reports_invalid_lines(m, ctx):
+    location = f'imp{next(_seq)}:1'
+    lines = [
+        _document(location),
+        '{not json',
+        json.dumps({'bank': {'bank_name': 'x', 'bank_type': 'reading', 'location': 'nocolon', 'display_order': 1}}),
+        json.dumps({'bank': {'bank_name': 'x', 'bank_type': 'reading', 'location': 'a:b', 'display_order': '1'}}),
+        '',
+    ]
+    report = m.import_bank_documents(lines)
+    assert (report['inserted'], report['updated'], report['failed']) == (1, 0, 3)
+    assert [error['line'] for error in report['errors']] == [2, 3, 4]
+
+    bank, bigs, smalls, resources = _bank_tree(m, report['id_map'][location])
+    assert (bank.location_a, bank.location_b) == (location.split(':')[0], '1')
+    assert len(bigs) == 1 and smalls == [(1, 'A')] and resources == 1
+
+
+def test_upsert_updates_in_place_and_keeps_ids(m, ctx):
+    location = f'imp{next(_seq)}:1'
+    first = m.import_bank_documents([_document(location)])
+    bank_id = first['id_map'][location]
+    small_id = m.SmallQuestion.query.join(m.BigQuestion, m.BigQuestion.big_id == m.SmallQuestion.big_id).filter(
+        m.BigQuestion.bank_id == bank_id).one().small_id
+
+    report = m.import_bank_documents([_document(location, name='Renamed', answer='B', extra_small=True)],
+                                     upsert=True)
+    assert (report['inserted'], report['updated'], report['failed']) == (0, 1, 0)
+    assert report['id_map'][location] == bank_id
+
+    bank, bigs, smalls, resources = _bank_tree(m, bank_id)
+    assert bank.bank_name == 'Renamed'
+    assert len(bigs) == 1 and resources == 1
+    assert smalls == [(1, 'B'), (2, 'B')]
+    # 已有小题原地更新，答题记录引用的 small_id 不变
+    assert m.db.session.get(m.SmallQuestion, small_id).question_answer == 'B'
+
+
+def test_insert_mode_duplicates_existing_bank(m, ctx):
+    location = f'imp{next(_seq)}:1'
+    m.import_bank_documents([_document(location)])
+    report = m.import_bank_documents([_document(location)])
+    assert report['inserted'] == 1
+    assert m.Bank.query.filter_by(location=location).count() == 2
+
+
+def test_export_round_trips_through_upsert(m, ctx):
+    location = f'imp{next(_seq)}:1'
+    bank_id = m.import_bank_documents([_document(location, extra_small=True)])['id_map'][location]
+    exported = list(m.export_bank_documents(bank_ids=[bank_id]))
+    assert len(exported) == 1
+    report = m.import_bank_documents(exported, upsert=True)
+    assert (report['inserted'], report['updated']) == (0, 1)
+    assert _bank_tree(m, bank_id)[2] == [(1, 'A'), (2, 'B')]
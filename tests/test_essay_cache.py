@@ -0,0 +1,35 @@
+import datetime
+
+
+def _put(m, cache, key, used_at):
+    cache.put(key, 'model', 1, 1, None, {'evaluation': 'x' * 80, 'scores': {}})
+    m.EssayEvaluationCache.query.filter_by(cache_key=key).update({'last_used_at': used_at})
+
+
+def test_evict_removes_least_recently_used_down_to_low_water(m, ctx):
+    m.EssayEvaluationCache.query.delete()
+    start = datetime.datetime(2024, 1, 1)
+    cache = m.EssayCache(max_bytes=1000, near_duplicate=False, threshold=0.9)
+    for i in range(12):
+        _put(m, cache, f'k{i:02d}', start + datetime.timedelta(minutes=i))
+
+    keys = [key for (key,) in m.db.session.query(m.EssayEvaluationCache.cache_key).order_by(
+        m.EssayEvaluationCache.cache_key)]
+    stored = m.EssayCache._stored_bytes()
+    assert stored <= 1000
+    assert cache.total == stored
+    # 淘汰的是最早使用的记录，最新的仍然保留
+    assert keys == [f'k{i:02d}' for i in range(12 - len(keys), 12)]
+    assert len(keys) < 12
+
+
+def test_put_uses_running_total_between_resyncs(m, ctx, monkeypatch):
+    m.EssayEvaluationCache.query.delete()
+    cache = m.EssayCache(max_bytes=10 ** 9, near_duplicate=False, threshold=0.9)
+    calls = []
+    real = m.EssayCache._stored_bytes
+    monkeypatch.setattr(m.EssayCache, '_stored_bytes', staticmethod(lambda: calls.append(1) or real()))
+    for i in range(5):
+        _put(m, cache, f'r{i}', datetime.datetime(2024, 1, 1))
+    assert len(calls) == 1
+    assert cache.total == real()
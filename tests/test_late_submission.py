@@ -0,0 +1,63 @@
+import datetime
+import itertools
+
+import pytest
+
+_seq = itertools.count(1)
+
+
+@pytest.fixture
+def rebuilt_coursework(m, ctx):
+    """截止时间已过、分配已重建的作业：三名学生互评一篇，第四名学生尚未提交"""
+    db = m.db
+    n = next(_seq)
+    now = datetime.datetime.utcnow()
+    cls = m.Class(classname=f'late-{n}', creator_id=1)
+    bank = m.Bank(bank_name=f'late-{n}', bank_type='writing')
+    students = [m.Student(username=f'late-{n}-{i}', email=f'late-{n}-{i}@x', password='x') for i in range(4)]
+    db.session.add_all([cls, bank, *students])
+    db.session.flush()
+    cw = m.Coursework(class_id=cls.class_id, create_time=now - datetime.timedelta(days=30),
+                      deadline=now - datetime.timedelta(hours=1), review_set='count: 1',
+                      avg_score=0.0, matching_state='rebuilt')
+    db.session.add(cw)
+    db.session.flush()
+    db.session.add(m.CwBank(cw_id=cw.cw_id, bank_id=bank.bank_id))
+    ids = [s.student_id for s in students]
+    db.session.add_all([m.StudentCourses(student_id=sid, class_id=cls.class_id) for sid in ids])
+    m.write_peer_review_matching(cw.cw_id, [(ids[0], ids[1]), (ids[1], ids[2]), (ids[2], ids[0])])
+    db.session.commit()
+    return cw, bank.bank_id, ids
+
+
+def _pairs(m, cw_id):
+    return sorted((r.reviewer_id, r.student_id) for r in m.Matching.query.filter_by(cw_id=cw_id))
+
+
+def test_late_submission_within_window_joins_matching(m, rebuilt_coursework):
+    cw, bank_id, ids = rebuilt_coursework
+    patched = m.patch_late_submission(ids[3], bank_id, cw.deadline + datetime.timedelta(minutes=30))
+    assert patched == [cw.cw_id]
+    pairs = _pairs(m, cw.cw_id)
+    assert len(pairs) == 4
+    assert sum(1 for reviewer, _ in pairs if reviewer == ids[3]) == 1
+    assert sum(1 for _, student in pairs if student == ids[3]) == 1
+    # 其他学生的评审数与被评数不变
+    for sid in ids:
+        assert sum(1 for reviewer, _ in pairs if reviewer == sid) == 1
+        assert sum(1 for _, student in pairs if student == sid) == 1
+
+
+def test_practice_submission_after_window_does_not_patch(m, rebuilt_coursework):
+    cw, bank_id, ids = rebuilt_coursework
+    before = _pairs(m, cw.cw_id)
+    later = cw.deadline + datetime.timedelta(hours=m.app.config['LATE_REVIEW_WINDOW_HOURS'] + 1)
+    assert m.patch_late_submission(ids[3], bank_id, later) == []
+    assert _pairs(m, cw.cw_id) == before
+
+
+def test_submission_before_deadline_does_not_patch(m, rebuilt_coursework):
+    cw, bank_id, ids = rebuilt_coursework
+    before = _pairs(m, cw.cw_id)
+    assert m.patch_late_submission(ids[3], bank_id, cw.deadline - datetime.timedelta(minutes=1)) == []
+    assert _pairs(m, cw.cw_id) == before
@@ -0,0 +1,29 @@
+import itertools
+
+_seq = itertools.count(1)
+
+
+def test_import_does_not_start_background_workers(m):
+    assert not m.scoring_queue.threads
+    assert not m.detection_queue.threads
+    assert m.peer_review_scheduler.thread is None
+
+
+def test_writing_submission_rejected_when_queue_full(m, ctx, client, monkeypatch):
+    n = next(_seq)
+    bank = m.Bank(bank_name=f'queue-{n}', bank_type='writing', location=f'q{n}:1', display_order=1)
+    m.db.session.add_all([bank, m.ScoringJob(sub_id=-n, status='pending')])
+    m.db.session.commit()
+    pending = m.db.session.query(m.ScoringJob).filter_by(status='pending').count()
+    monkeypatch.setattr(m.scoring_queue, 'max_pending', pending)
+    submissions = m.Submission.query.count()
+
+    resp = client.post('/api/submit', json={
+        'user': {'token': 1},
+        'exercise': {'bank_type': 'writing', 'a': f'q{n}', 'b': '1', 'display_order': 1},
+        'performance': {'timer': 10},
+        'answers': {}
+    })
+    assert resp.status_code == 503
+    assert resp.headers['Retry-After'] == '30'
+    assert m.Submission.query.count() == submissions
@@ -0,0 +1,41 @@
+def _manager(m, capacity=2):
+    return m.AsyncTaskManager(max_tasks=capacity, done_ttl=3600, processing_ttl=3600, stripes=1)
+
+
+def test_full_stripe_evicts_oldest_completed(m):
+    tasks = _manager(m)
+    tasks.add_task(1)
+    tasks.add_task(2)
+    tasks.mark_done(2, {'score': 1})
+    assert tasks.add_task(3) is not None
+    assert tasks.get_task(1) is not None
+    assert tasks.get_task(2) is None
+    assert tasks.stats()['evicted'] == 1
+
+
+def test_full_stripe_of_processing_tasks_refuses_new_task(m):
+    tasks = _manager(m)
+    first = tasks.add_task(1)
+    tasks.add_task(2)
+    assert tasks.add_task(3) is None
+    assert tasks.get_task(1) is first
+    assert tasks.get_task(3) is None
+    stats = tasks.stats()
+    assert (stats['processing'], stats['evicted'], stats['rejected']) == (2, 0, 1)
+
+    tasks.mark_done(1, {'score': 1})
+    assert tasks.add_task(3) is not None
+
+
+def test_existing_task_is_returned_when_full(m):
+    tasks = _manager(m)
+    first = tasks.add_task(1)
+    tasks.add_task(2)
+    assert tasks.add_task(1) is first
+
+
+def test_expired_processing_task_frees_slot(m):
+    tasks = m.AsyncTaskManager(max_tasks=1, done_ttl=3600, processing_ttl=0, stripes=1)
+    tasks.add_task(1)
+    assert tasks.add_task(2) is not None
+    assert tasks.stats()['rejected'] == 0